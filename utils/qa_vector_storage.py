@@ -83,12 +83,92 @@ def store_support_answer(question, answer, source="Especialista de Soporte"):
     except Exception as e:
         error_message = str(e)
         print(f"❌ Error storing support answer: {error_message}")
-        
+
+        # Clean up temporary file if it exists
+        if temp_file_path and os.path.exists(temp_file_path):
+            try:
+                os.remove(temp_file_path)
+            except:
+                pass
+
+        return False, f"Error: {error_message}"
+
+def store_support_answers_batch(qa_pairs):
+    """
+    Store several question-answer pairs in the vector database in one pass.
+
+    Uploading one document with all the pairs amortizes the file upload and
+    vector store indexing round-trips over the whole batch instead of paying
+    them once per pair.
+
+    Args:
+        qa_pairs: Iterable of (question, answer, source) tuples
+
+    Returns:
+        success: Boolean indicating if the operation was successful
+        message: A message describing the result or error
+    """
+    if not VECTOR_STORE_ID:
+        print("⚠️ Vector store ID not found. Support answers were not stored.")
+        return False, "Vector store ID not found"
+
+    qa_pairs = list(qa_pairs)
+    if not qa_pairs:
+        return True, "No support answers to store"
+
+    temp_file_path = None
+    try:
+        # Create a single temporary JSON file with all the QA pairs
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as temp_file:
+            date_added = datetime.now().isoformat()
+            qa_data = [
+                {
+                    "question": question,
+                    "answer": answer,
+                    "source": source,
+                    "date_added": date_added
+                }
+                for question, answer, source in qa_pairs
+            ]
+
+            json.dump(qa_data, temp_file, ensure_ascii=False, indent=2)
+            temp_file_path = temp_file.name
+
+        print(f"✓ Created QA batch file with {len(qa_pairs)} pairs: {temp_file_path}")
+
+        # Upload the file to OpenAI
+        with open(temp_file_path, "rb") as file_content:
+            file_response = client.files.create(
+                file=file_content,
+                purpose="assistants"
+            )
+
+        file_id = file_response.id
+        print(f"✓ Uploaded file with ID: {file_id}")
+
+        # Add the file to the vector store
+        result = client.vector_stores.files.create(
+            vector_store_id=VECTOR_STORE_ID,
+            file_id=file_id
+        )
+
+        print(f"✓ Added file to vector store: {result}")
+
+        # Clean up temporary file
+        if temp_file_path and os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+
+        return True, f"Successfully stored {len(qa_pairs)} support answers in the vector database"
+
+    except Exception as e:
+        error_message = str(e)
+        print(f"❌ Error storing support answers: {error_message}")
+
         # Clean up temporary file if it exists
         if temp_file_path and os.path.exists(temp_file_path):
             try:
                 os.remove(temp_file_path)
             except:
                 pass
-                
+
         return False, f"Error: {error_message}" 
\ No newline at end of file
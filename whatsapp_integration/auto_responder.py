@@ -6,7 +6,6 @@ y responde automáticamente con un mensaje predefinido.
 """
 
 import os
-import json
 import asyncio
 import logging
 from aiohttp import web
@@ -26,13 +25,15 @@ load_dotenv()
 # Configurar mensaje de respuesta automática
 AUTO_REPLY_MESSAGE = "Gracias por tu mensaje. Esta es una respuesta automática del sistema."
 
+# Estos valores no cambian en ejecución: leerlos una vez al importar evita
+# la consulta a os.environ en cada mensaje
+VERIFY_TOKEN = os.environ.get("WHATSAPP_VERIFY_TOKEN", "c1d01-whatsapp-verify")
+PHONE_NUMBER_ID = os.environ.get("WHATSAPP_PHONE_NUMBER_ID")
+
 async def verify_webhook(request):
     """
     Verifica el webhook de WhatsApp cuando Meta intenta verificarlo.
     """
-    # Token de verificación definido en Meta Developer Portal
-    verify_token = os.environ.get("WHATSAPP_VERIFY_TOKEN", "c1d01-whatsapp-verify")
-    
     # Parámetros de la solicitud de verificación
     mode = request.query.get("hub.mode")
     token = request.query.get("hub.verify_token")
@@ -41,7 +42,7 @@ async def verify_webhook(request):
     logger.info(f"Recibida solicitud de verificación: mode={mode}, token={token}")
     
     # Verificar que sea una solicitud de suscripción y que el token coincida
-    if mode == "subscribe" and token == verify_token:
+    if mode == "subscribe" and token == VERIFY_TOKEN:
         logger.info("Webhook verificado correctamente")
         return web.Response(text=challenge)
     else:
@@ -56,18 +57,15 @@ async def send_auto_reply(to_number):
         to_number: Número al que se enviará la respuesta automática
     """
     try:
-        # Obtener ID del teléfono de WhatsApp Business
-        phone_number_id = os.environ.get("WHATSAPP_PHONE_NUMBER_ID")
-        
-        # Enviar mensaje automático
-        result = await send_whatsapp_message(to_number, AUTO_REPLY_MESSAGE, phone_number_id)
+        # Enviar mensaje automático (el ID del teléfono ya está cacheado)
+        result = await send_whatsapp_message(to_number, AUTO_REPLY_MESSAGE, PHONE_NUMBER_ID)
         
         # Verificar resultado
         if "success" in result and result["success"]:
             logger.info(f"Respuesta automática enviada a {to_number}")
             return True
         else:
-            logger.error(f"Error al enviar respuesta automática: {json.dumps(result)}")
+            logger.error("Error al enviar respuesta automática: %r", result)
             return False
     
     except Exception as e:
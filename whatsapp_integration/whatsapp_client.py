@@ -8,8 +8,10 @@ y funciones de utilidad para enviar mensajes.
 import os
 import json
 import logging
+import functools
 import aiohttp
 import asyncio
+import orjson
 from dotenv import load_dotenv
 
 # Configurar logging
@@ -22,6 +24,66 @@ logger = logging.getLogger("whatsapp_client")
 # Cargar variables de entorno
 load_dotenv()
 
+# Tabla precompilada para normalizar números: una sola pasada en C elimina
+# '+', guiones, espacios y paréntesis, en lugar de encadenar varios replace
+_PHONE_TRANS = str.maketrans("", "", "+-() ")
+
+# Sesión HTTP compartida hacia graph.facebook.com: reutilizar conexiones
+# evita pagar el handshake TCP+TLS en cada mensaje enviado
+_http_session = None
+
+def _get_http_session():
+    """Devuelve la sesión HTTP compartida, creándola en el primer envío."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=20,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+        )
+    return _http_session
+
+async def close_http_session():
+    """Cierra la sesión HTTP compartida (llamar al apagar el servidor)."""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+@functools.lru_cache(maxsize=128)
+def _template_payload_bytes(template_name, language="es"):
+    """
+    Serializa una sola vez el payload de plantilla (sin destinatario).
+
+    En un envío masivo con la misma plantilla esto evita reconstruir
+    y re-serializar el mismo diccionario en cada llamada.
+    """
+    return orjson.dumps({
+        "messaging_product": "whatsapp",
+        "recipient_type": "individual",
+        "type": "template",
+        "template": {
+            "name": template_name,
+            "language": {"code": language}
+        }
+    })
+
+
+def _template_payload(to_phone_number, template_name, language="es"):
+    """
+    Construye el payload de plantilla para un destinatario concreto.
+
+    Como el orden de las claves en JSON es irrelevante, se antepone el
+    destinatario a los bytes cacheados sin volver a serializar el resto.
+    """
+    cached = _template_payload_bytes(template_name, language)
+    return b'{"to":"' + to_phone_number.encode("ascii") + b'",' + cached[1:]
+
+
 class WhatsAppClient:
     """
     Cliente para interactuar con la API de WhatsApp Business.
@@ -72,8 +134,7 @@ class WhatsAppClient:
             dict: La respuesta de la API de WhatsApp
         """
         # Asegurarse de que el número de teléfono del destinatario tenga el formato correcto
-        if to_phone_number.startswith("+"):
-            to_phone_number = to_phone_number[1:]
+        to_phone_number = to_phone_number.translate(_PHONE_TRANS)
             
         # Construir la URL de la API
         url = f"https://graph.facebook.com/{self.api_version}/{self.phone_number_id}/messages"
@@ -89,17 +150,8 @@ class WhatsAppClient:
                 "text": {"body": message_text}
             }
         else:
-            # Mensaje con plantilla
-            payload = {
-                "messaging_product": "whatsapp",
-                "recipient_type": "individual",
-                "to": to_phone_number,
-                "type": "template",
-                "template": {
-                    "name": template_name,
-                    "language": {"code": "es"}
-                }
-            }
+            # Mensaje con plantilla (bytes pre-serializados y cacheados)
+            payload = _template_payload(to_phone_number, template_name)
         
         # Si no hay token de acceso, mostrar solo el ejemplo
         if not self.access_token:
@@ -109,20 +161,23 @@ class WhatsAppClient:
             logger.warning("2. Usar ese token en la solicitud con el header 'Authorization: Bearer <access_token>'")
             logger.warning(f"3. Enviar una solicitud POST a: {url}")
             
+            payload_str = payload.decode() if isinstance(payload, bytes) else json.dumps(payload)
             logger.info("Ejemplo de comando curl:")
             logger.info(f"""
             curl -X POST \\
               '{url}' \\
               -H 'Authorization: Bearer <TU_TOKEN_DE_ACCESO>' \\
               -H 'Content-Type: application/json' \\
-              -d '{json.dumps(payload)}'
+              -d '{payload_str}'
             """)
             
             return {
                 "success": False,
                 "message": "Este es solo un ejemplo. Necesitas configurar un token de acceso válido para enviar mensajes reales.",
                 "url": url,
-                "payload": payload
+                # Devolver siempre la forma dict: los bytes cacheados son un
+                # detalle del envío HTTP y romperían json.dumps en los llamadores
+                "payload": orjson.loads(payload) if isinstance(payload, bytes) else payload
             }
         
         # Si hay token de acceso, enviar el mensaje real
@@ -132,21 +187,26 @@ class WhatsAppClient:
         }
         
         try:
-            # Enviar la solicitud a la API
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=payload, headers=headers) as response:
-                    response_text = await response.text()
-                    try:
-                        response_data = json.loads(response_text)
-                    except:
-                        response_data = {"text": response_text}
-                    
-                    if response.status == 200:
-                        logger.info(f"Mensaje enviado correctamente: {response_data}")
-                        return {"success": True, "data": response_data}
-                    else:
-                        logger.error(f"Error al enviar mensaje: {response.status} - {response_text}")
-                        return {"success": False, "error": f"Error {response.status}", "data": response_data}
+            # Enviar la solicitud a la API (los payloads de plantilla ya vienen serializados)
+            if isinstance(payload, bytes):
+                request_args = {"data": payload}
+            else:
+                request_args = {"json": payload}
+
+            session = _get_http_session()
+            async with session.post(url, headers=headers, **request_args) as response:
+                # Decodificar el cuerpo una sola vez, directamente desde bytes
+                try:
+                    response_data = await response.json(loads=orjson.loads, content_type=None)
+                except (aiohttp.ContentTypeError, ValueError):
+                    response_data = {"text": await response.text()}
+
+                if response.status == 200:
+                    logger.info(f"Mensaje enviado correctamente: {response_data}")
+                    return {"success": True, "data": response_data}
+                else:
+                    logger.error(f"Error al enviar mensaje: {response.status} - {response_data}")
+                    return {"success": False, "error": f"Error {response.status}", "data": response_data}
         except Exception as e:
             logger.error(f"Error al enviar mensaje: {str(e)}")
             return {"success": False, "error": str(e)}
@@ -7,28 +7,27 @@ con derivación a especialista humano cuando es necesario.
 """
 
 import os
+import re
 import sys
-import json
 import asyncio
 import logging
+import orjson
+import aiohttp
 from aiohttp import web
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from itertools import islice
 from datetime import datetime
 from dotenv import load_dotenv
-import threading
-import queue
 import time
-import requests
 import uuid
+import functools
 
 # Añadir el directorio raíz al path para importar los módulos
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 
-# Importar funciones y clases necesarias
-from agents import Runner, set_default_openai_key
-from utility_agents.simple_response_agent import simple_response_agent
-from utility_agents.human_support_agent import human_support_agent
-from whatsapp_integration.whatsapp_client import send_whatsapp_message
-from utils.qa_vector_storage import store_support_answer
+# Importar funciones y clases necesarias (los módulos pesados se difieren a su primer uso)
+from whatsapp_integration.whatsapp_client import close_http_session, send_whatsapp_message
 
 # Configurar logging
 logging.basicConfig(
@@ -51,22 +50,147 @@ NOTION_DATABASE_ID = os.environ.get("NOTION_DATABASE_ID")
 if not NOTION_API_KEY or not NOTION_DATABASE_ID:
     logger.warning("Credenciales de Notion no encontradas, la integración con Notion no estará disponible")
 
-# Establecer la API key por defecto
-set_default_openai_key(openai_api_key)
+# URL y cabeceras de la API de Notion: son idénticas en todas las llamadas,
+# así que se construyen una sola vez al importar el módulo
+NOTION_PAGES_URL = "https://api.notion.com/v1/pages"
+NOTION_HEADERS = {
+    "Authorization": f"Bearer {NOTION_API_KEY}",
+    "Content-Type": "application/json",
+    "Notion-Version": "2022-06-28"
+} if NOTION_API_KEY else None
 
 # Estructuras de datos para gestión de conversaciones
-conversation_histories = {}  # Historiales por número
-message_queue = queue.Queue()  # Cola de mensajes entrantes
-pending_human_queries = {}  # Diccionario de consultas pendientes de respuesta humana
-original_questions = {}  # Almacenamiento de consultas originales
+MAX_HISTORY = 10  # Turnos (pregunta, respuesta) retenidos por número
+PENDING_TTL = 86400  # Segundos que una consulta puede quedar pendiente en Redis
+conversation_histories = {}  # Historiales por número (deque acotada por número)
+conversation_prompt_cache = OrderedDict()  # Prefijo de contexto ya renderizado por número (LRU acotada)
+_PROMPT_CACHE_MAX = 1024  # Números con prefijo cacheado antes de expulsar el menos usado
+pending_human_queries = {}  # Consultas pendientes de respuesta humana (con su pregunta original)
+
+# IDs de mensajes ya vistos: Meta reintenta los webhooks que no confirma a
+# tiempo, y sin esto cada reintento dispararía de nuevo al agente y crearía
+# tickets duplicados en Notion. OrderedDict como LRU acotada.
+_seen_message_ids = OrderedDict()
+_SEEN_MAX = 10_000
+
+# IDs de mensajes salientes a verificar cuando llegue su confirmación. Solo
+# se tocan desde el loop de asyncio (sin locks) y se acotan en tamaño y edad:
+# si la confirmación nunca llega, la entrada no debe quedar pinneada para siempre
+outgoing_message_ids = OrderedDict()
+_OUTGOING_MAX = 10_000
+OUTGOING_TTL = 3600  # Segundos que se retiene un ID saliente sin confirmar
+
+def _remember_outgoing(message_id, recipient, timestamp):
+    """Registra un mensaje saliente, expulsando entradas viejas o de más."""
+    now = time.time()
+    outgoing_message_ids[message_id] = {
+        'recipient': recipient,
+        'timestamp': timestamp,
+        'added_ts': now
+    }
+    while len(outgoing_message_ids) > _OUTGOING_MAX:
+        outgoing_message_ids.popitem(last=False)
+    while outgoing_message_ids:
+        oldest = next(iter(outgoing_message_ids.values()))
+        if now - oldest['added_ts'] <= OUTGOING_TTL:
+            break
+        outgoing_message_ids.popitem(last=False)
+
+def _is_duplicate_message(message_id):
+    """Marca un ID de mensaje como visto; True si ya había llegado antes."""
+    if message_id in _seen_message_ids:
+        return True
+    _seen_message_ids[message_id] = None
+    if len(_seen_message_ids) > _SEEN_MAX:
+        _seen_message_ids.popitem(last=False)
+    return False
 our_phone_number_id = os.environ.get("WHATSAPP_PHONE_NUMBER_ID")  # ID de nuestro teléfono para identificar mensajes salientes
 
+# Token de verificación definido en Meta Developer Portal (leído una sola vez)
+VERIFY_TOKEN = os.environ.get("WHATSAPP_VERIFY_TOKEN", "c1d01-whatsapp-verify")
+
+# Sesión HTTP compartida para la API de Notion: reutiliza conexiones TCP/TLS
+# entre tickets en vez de pagar el handshake en cada llamada. Se crea y se
+# cierra con el ciclo de vida de la aplicación aiohttp.
+notion_session = None
+
+async def _init_http_sessions(app):
+    """Crea las sesiones HTTP compartidas y conecta el estado al arrancar."""
+    global notion_session
+    notion_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=20, keepalive_timeout=60)
+    )
+    await store.connect()
+
+async def _close_http_sessions(app):
+    """Cierra las sesiones HTTP compartidas al detener el servidor."""
+    if notion_session is not None:
+        await notion_session.close()
+    await close_http_session()
+    await store.close()
+
+# Patrones precompilados para rescatar datos del JSON crudo de Notion cuando
+# la extracción estructurada de propiedades no encuentra los campos
+_PHONE_PATTERNS = (
+    re.compile(r'"content"\s*:\s*"(5\d{10})"'),  # Número chileno
+    re.compile(r'"content"\s*:\s*"(\+?\d{8,15})"')  # Cualquier número de teléfono
+)
+_RESP_PATTERN = re.compile(r'"content"\s*:\s*"([^"]{2,100})"')
+
+# Nombres conocidos de la propiedad con el teléfono en la base de Notion,
+# ya en minúsculas: las variantes de mayúsculas se resuelven indexando las
+# propiedades por clave casefold en vez de sondear cada combinación
+_PHONE_KEYS = ("celular", "teléfono", "telefono")
+
+def _extract_rich_text(prop):
+    """Extrae el texto plano de una propiedad rich_text de Notion."""
+    rich_text = prop.get('rich_text') if prop else None
+    return rich_text[0].get('text', {}).get('content', '') if rich_text else ''
+
+def _extract_title(prop):
+    """Extrae el texto plano de una propiedad title de Notion."""
+    title = prop.get('title') if prop else None
+    return title[0].get('text', {}).get('content', '') if title else ''
+
+# Cuerpo pre-serializado de la respuesta de confirmación del webhook
+_OK_BODY = b"OK"
+
+# Aviso fijo para usuarios cuya consulta está en manos de un especialista
+HUMAN_WAIT_REPLY = ("Tu consulta ha sido transferida a un especialista humano. "
+                    "En breve recibirás una respuesta. Gracias por tu paciencia.")
+HUMAN_WAIT_ACK_INTERVAL = 60  # Segundos mínimos entre avisos repetidos al mismo usuario
+
+# Cola de mensajes entrantes sobre el loop de aiohttp: el webhook encola y
+# AGENT_CONCURRENCY workers consumen en paralelo. El semáforo mantiene un
+# tope duro compartido con cualquier otra ruta que invoque a los agentes.
+AGENT_CONCURRENCY = int(os.environ.get("AGENT_CONCURRENCY", "5"))
+
+# El loop solo guarda referencias débiles a las tareas: sin retenerlas acá,
+# el recolector de basura puede cancelar un handler (o un worker) en pleno vuelo
+_background_tasks = set()
+
+def _spawn(coro):
+    """Crea una tarea reteniendo su referencia hasta que termine."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Separadores de consola construidos una sola vez
+_SEP = "=" * 70
+_SUBSEP = "-" * 70
+
+# Tamaño máximo aceptado para el cuerpo de un webhook: los de texto de
+# WhatsApp pesan unos pocos KB, todo lo demás es abuso o error
+MAX_WEBHOOK_BODY = 64 * 1024
+message_queue = asyncio.Queue()
+_agent_semaphore = asyncio.Semaphore(AGENT_CONCURRENCY)
+
 # Custom run result handler para recopilar datos de ejecución
 class RunTracker:
+    __slots__ = ('handoffs', 'vector_results', 'agent_names', 'contexts')
+
     def __init__(self):
-        self.reset()
-    
-    def reset(self):
         self.handoffs = []
         self.vector_results = []
         self.agent_names = []
@@ -74,127 +198,399 @@ class RunTracker:
     
     def format_logs(self):
         """Formatea logs internos para visualización"""
-        logs = []
+        # Se acumulan fragmentos y se concatena una sola vez al final,
+        # evitando las concatenaciones intermedias con '+'
+        parts = []
         
         if self.contexts:
-            logs.append("Contexto: " + "\n".join(self.contexts))
+            parts.append("Contexto: ")
+            parts.append("\n".join(self.contexts))
+            parts.append("\n")
         
         if self.handoffs:
-            logs.append("Handoffs: " + " -> ".join(self.handoffs))
+            parts.append("Handoffs: ")
+            parts.append(" -> ".join(self.handoffs))
+            parts.append("\n")
         
         if self.agent_names:
-            logs.append("Agentes utilizados: " + ", ".join(self.agent_names))
+            parts.append("Agentes utilizados: ")
+            parts.append(", ".join(self.agent_names))
+            parts.append("\n")
         
         if self.vector_results:
-            logs.append("Resultados de búsqueda en vectores: ")
-            for result in self.vector_results:
-                logs.append(f"- {result}")
+            # Los resultados se guardan como tuplas crudas (archivo, score,
+            # texto) y se formatean recién acá, solo si alguien pide los logs
+            parts.append("Resultados de búsqueda en vectores: ")
+            for entry in self.vector_results:
+                if isinstance(entry, tuple):
+                    filename, score, text = entry
+                    snippet = text[:100] + "..." if len(text) > 100 else text
+                    parts.append(f"\n- Archivo: {filename}, Relevancia: {score:.2f}, Extracto: {snippet}")
+                else:
+                    parts.append(f"\n- {entry}")
+            parts.append("\n")
         
-        return "\n".join(logs)
+        if parts:
+            parts.pop()  # sin salto de línea final
+        
+        return "".join(parts)
+
+@functools.lru_cache(maxsize=1)
+def _get_agents():
+    """
+    Importa y configura el sistema de agentes en su primer uso.
 
-# Crear tracker
-tracker = RunTracker()
+    El SDK de agentes y sus dependencias son costosos de importar; diferirlos
+    acelera el arranque y evita cargarlos si solo se atiende la verificación
+    del webhook.
+    """
+    from agents import Runner, set_default_openai_key
+    from utility_agents.simple_response_agent import simple_response_agent
+    from utility_agents.human_support_agent import human_support_agent
+
+    # Establecer la API key por defecto
+    set_default_openai_key(openai_api_key)
+
+    # Los nombres se resuelven una sola vez aquí para no pagar la
+    # resolución de atributos en cada mensaje
+    return Runner, simple_response_agent, simple_response_agent.name, human_support_agent.name
+
+# Cola de pares (pregunta, respuesta, fuente) pendientes de almacenar en vectores
+_answer_flush_queue = asyncio.Queue()
+ANSWER_FLUSH_WINDOW = 1.0  # Segundos de espera para agrupar almacenamientos
+
+async def _answer_flusher():
+    """
+    Agrupa los pares Q&A encolados y los almacena en la base vectorial en lotes.
+
+    Esperar una ventana corta tras el primer par permite que una tanda de
+    respuestas humanas se suba en una sola llamada en vez de N.
+    """
+    from utils.qa_vector_storage import store_support_answers_batch
+
+    while True:
+        batch = [await _answer_flush_queue.get()]
+        try:
+            while True:
+                batch.append(await asyncio.wait_for(
+                    _answer_flush_queue.get(), timeout=ANSWER_FLUSH_WINDOW
+                ))
+        except asyncio.TimeoutError:
+            pass
+
+        try:
+            # El cliente OpenAI es síncrono: ejecutarlo fuera del loop
+            success, message = await asyncio.to_thread(store_support_answers_batch, batch)
+            if success:
+                logger.info("Lote de respuestas almacenado: %s", message)
+            else:
+                logger.error("Error al almacenar lote de respuestas: %s", message)
+        except Exception as e:
+            logger.error("Error en el almacenamiento por lotes: %s", e)
+
+@dataclass(slots=True)
+class PendingQuery:
+    """Consulta en espera de respuesta humana (modo en memoria)."""
+    question: str
+    timestamp: datetime
+    last_ack_ts: float = None
+
+class ConversationStore:
+    """
+    Punto único de acceso al estado de conversaciones: historiales por número
+    y consultas pendientes de respuesta humana.
+
+    Si REDIS_URL está configurada (y el paquete redis instalado), el estado
+    vive en Redis y puede compartirse entre varios procesos detrás de un
+    balanceador; si no, se usan las estructuras en memoria de siempre.
+    """
+
+    def __init__(self):
+        self._redis = None
+
+    @property
+    def is_shared(self):
+        """True si el estado vive en Redis y otros procesos pueden mutarlo."""
+        return self._redis is not None
+
+    async def connect(self):
+        """Conecta a Redis si está configurado; si no, queda en memoria."""
+        redis_url = os.environ.get("REDIS_URL")
+        if not redis_url:
+            return
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:
+            logger.warning("REDIS_URL configurada pero el paquete redis no está instalado, "
+                           "se usará el estado en memoria")
+            return
+        self._redis = aioredis.from_url(redis_url)
+        logger.info("Estado de conversaciones respaldado en Redis")
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.close()
+
+    # --- Historial de conversación ---
+
+    async def append_history(self, number, question, answer):
+        """Agrega un turno (pregunta, respuesta) al historial del número."""
+        if self._redis is not None:
+            # RPUSH + LTRIM encadenados en un pipeline: un solo viaje a Redis
+            key = f"hist:{number}"
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.rpush(key, orjson.dumps([question, answer]).decode())
+            pipe.ltrim(key, -MAX_HISTORY, -1)
+            await pipe.execute()
+        else:
+            conversation_histories.setdefault(number, deque(maxlen=MAX_HISTORY)).append((question, answer))
+            # El prefijo cacheado queda obsoleto: se re-renderiza en el próximo mensaje
+            conversation_prompt_cache.pop(number, None)
+
+    async def recent_history(self, number, n=3):
+        """Devuelve los últimos n turnos (pregunta, respuesta) del número."""
+        if self._redis is not None:
+            raw = await self._redis.lrange(f"hist:{number}", -n, -1)
+            return [tuple(orjson.loads(item)) for item in raw]
+        history = conversation_histories.get(number)
+        if not history:
+            return []
+        return list(islice(history, max(0, len(history) - n), None))
+
+    # --- Consultas pendientes de respuesta humana ---
+
+    async def is_pending(self, number):
+        """Indica si el número está esperando respuesta de un especialista."""
+        if self._redis is not None:
+            return bool(await self._redis.exists(f"pending:{number}"))
+        # En régimen normal no hay nada pendiente: la prueba de vacío es una
+        # sola rama y evita hashear el número en el camino de cada mensaje
+        if not pending_human_queries:
+            return False
+        return number in pending_human_queries
+
+    async def mark_pending(self, number, question, timestamp):
+        """Registra una consulta en espera de respuesta humana."""
+        if self._redis is not None:
+            key = f"pending:{number}"
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.hset(key, mapping={"question": question, "timestamp": timestamp.isoformat()})
+            pipe.expire(key, PENDING_TTL)
+            await pipe.execute()
+            return
+        pending_human_queries[number] = PendingQuery(question, timestamp)
+
+    async def clear_pending(self, number):
+        """Elimina una consulta pendiente."""
+        if self._redis is not None:
+            await self._redis.delete(f"pending:{number}")
+            return
+        pending_human_queries.pop(number, None)
+
+    async def pending_question(self, number):
+        """Recupera la pregunta original de una consulta pendiente."""
+        if self._redis is not None:
+            question = await self._redis.hget(f"pending:{number}", "question")
+            if isinstance(question, bytes):
+                question = question.decode()
+            return question or ''
+        entry = pending_human_queries.get(number)
+        return entry.question if entry else ''
+
+    async def pop_pending(self, number):
+        """Extrae la pregunta pendiente y la elimina en una sola sonda."""
+        if self._redis is not None:
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.hget(f"pending:{number}", "question")
+            pipe.delete(f"pending:{number}")
+            question, _ = await pipe.execute()
+            if isinstance(question, bytes):
+                question = question.decode()
+            return question
+        if not pending_human_queries:
+            return None
+        entry = pending_human_queries.pop(number, None)
+        return entry.question if entry else None
+
+    async def pending_numbers(self):
+        """Lista de números con consultas pendientes (para diagnósticos)."""
+        if self._redis is not None:
+            keys = await self._redis.keys("pending:*")
+            return [(k.decode() if isinstance(k, bytes) else k).split(":", 1)[1] for k in keys]
+        return list(pending_human_queries.keys())
+
+    async def ack_allowed(self, number):
+        """True si corresponde repetir el aviso de espera (máx. 1 por minuto)."""
+        now = time.time()
+        if self._redis is not None:
+            key = f"pending:{number}"
+            last_ack = await self._redis.hget(key, "last_ack_ts")
+            if last_ack is not None and now - float(last_ack) < HUMAN_WAIT_ACK_INTERVAL:
+                return False
+            # Si la consulta se resolvió entre el chequeo de pendiente y este
+            # punto, no escribir: un HSET acá resucitaría la clave sin TTL ni
+            # pregunta y dejaría al número pendiente para siempre
+            if not await self._redis.exists(key):
+                return False
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.hset(key, "last_ack_ts", now)
+            pipe.expire(key, PENDING_TTL)
+            await pipe.execute()
+            return True
+        pending = pending_human_queries.get(number)
+        if pending is None:
+            return True
+        if pending.last_ack_ts is not None and now - pending.last_ack_ts < HUMAN_WAIT_ACK_INTERVAL:
+            return False
+        pending.last_ack_ts = now
+        return True
+
+# Estado compartido de conversaciones (conectado al arrancar el servidor)
+store = ConversationStore()
+
+def _render_history_prompt(history):
+    """Renderiza el prefijo de contexto con los últimos 3 turnos del historial."""
+    parts = ["\n\nHistorial de conversación anterior:\n"]
+    for user_msg, assistant_msg in islice(history, max(0, len(history) - 3), None):
+        parts.append(f"Usuario: {user_msg}\nAsistente: {assistant_msg}\n")
+    return "".join(parts)
+
+@dataclass(slots=True)
+class InboundMessage:
+    """Mensaje de texto entrante ya extraído del payload del webhook."""
+    sender: str
+    msg_id: str
+    text: str
+    ts: datetime
+
+def decode_webhook(body):
+    """
+    Recorre el payload del webhook de WhatsApp una sola vez.
+
+    Devuelve una tupla (mensajes, envíos): los mensajes de texto entrantes
+    como objetos InboundMessage y los estados 'sent' de mensajes salientes
+    como tuplas (recipient_id, message_id).
+    """
+    inbound = []
+    sent_statuses = []
+
+    # Verificar que sea un webhook de WhatsApp
+    if body.get('object') != 'whatsapp_business_account':
+        return inbound, sent_statuses
+
+    # Una sola lectura de reloj para todo el lote; se guarda el datetime y
+    # se formatea recién en los bordes (pantalla, Redis)
+    now = datetime.now()
+
+    for entry in body.get('entry', []):
+        for change in entry.get('changes', []):
+            # Solo interesan los cambios de mensajes o estados
+            if change.get('field') != 'messages':
+                continue
+            value = change.get('value', {})
+
+            # Mensajes entrantes: descartar por tipo antes de tocar el resto
+            # de campos (stickers, reacciones, etc. no pagan más lecturas)
+            for message in value.get('messages', []):
+                if message.get('type') != 'text':
+                    logger.debug("Mensaje de tipo %s no soportado", message.get('type'))
+                    continue
+                if _is_duplicate_message(message['id']):
+                    logger.info("Mensaje %s ya procesado, reintento de Meta descartado", message['id'])
+                    continue
+                inbound.append(InboundMessage(
+                    sender=message['from'],
+                    msg_id=message['id'],
+                    text=message.get('text', {}).get('body', ''),
+                    ts=now
+                ))
+
+            # Estados de mensajes salientes (para detectar respuestas manuales)
+            for status in value.get('statuses', []):
+                if status.get('status') == 'sent':
+                    sent_statuses.append((status.get('recipient_id'), status.get('id')))
+
+    return inbound, sent_statuses
 
 async def verify_webhook(request):
     """Verifica el webhook de WhatsApp cuando Meta intenta verificarlo."""
-    # Token de verificación definido en Meta Developer Portal
-    verify_token = os.environ.get("WHATSAPP_VERIFY_TOKEN", "c1d01-whatsapp-verify")
-    
     # Parámetros de la solicitud de verificación
     mode = request.query.get("hub.mode")
     token = request.query.get("hub.verify_token")
     challenge = request.query.get("hub.challenge")
     
-    logger.info(f"Solicitud de verificación recibida: mode={mode}, token={token}")
+    logger.info("Solicitud de verificación recibida: mode=%s, token=%s", mode, token)
     
     # Verificar que sea una solicitud de suscripción y que el token coincida
-    if mode == "subscribe" and token == verify_token:
+    if mode == "subscribe" and token == VERIFY_TOKEN:
         logger.info("Webhook verificado correctamente")
-        return web.Response(text=challenge)
+        # El challenge es ASCII: codificarlo directo evita la búsqueda de
+        # codificación utf-8 dentro de aiohttp (puede faltar en la solicitud)
+        return web.Response(body=(challenge or "").encode())
     else:
         logger.warning("Verificación de webhook fallida")
         return web.Response(status=403, text="Forbidden")
 
 async def process_webhook(request):
     """Procesa los mensajes entrantes del webhook de WhatsApp."""
+    # Rechazar cuerpos desmedidos antes de leerlos siquiera
+    if request.content_length is not None and request.content_length > MAX_WEBHOOK_BODY:
+        logger.warning("Webhook rechazado: cuerpo de %s bytes", request.content_length)
+        return web.Response(status=413, text="Payload demasiado grande")
+
     try:
-        # Obtener el cuerpo de la solicitud
-        body = await request.json()
-        
-        # Verificar que sea un webhook de WhatsApp
-        if 'object' in body and body['object'] == 'whatsapp_business_account':
-            # Procesar cada entrada
-            for entry in body.get('entry', []):
-                # Procesar cada cambio en la entrada
-                for change in entry.get('changes', []):
-                    # Verificar tipo de cambio (mensajes o estados)
-                    if change.get('field') == 'messages':
-                        value = change.get('value', {})
-                        
-                        # CASO 1: Procesar mensajes entrantes
-                        if 'messages' in value:
-                            for message in value.get('messages', []):
-                                # Obtener información del mensaje
-                                from_number = message.get('from')
-                                message_id = message.get('id')
-                                message_type = message.get('type')
-                                
-                                # Obtener el contenido del mensaje si es de texto
-                                if message_type == 'text':
-                                    message_text = message.get('text', {}).get('body', '')
-                                    
-                                    # Registrar mensaje recibido
-                                    logger.info(f"Mensaje recibido de {from_number}: {message_text}")
-                                    
-                                    # Mostrar información en consola
-                                    print("\n" + "="*50)
-                                    print(f"📱 MENSAJE RECIBIDO de {from_number}: \"{message_text}\"")
-                                    print("="*50)
-                                    
-                                    # Crear objeto de mensaje
-                                    message_data = {
-                                        'from': from_number,
-                                        'id': message_id,
-                                        'text': message_text,
-                                        'timestamp': datetime.now().isoformat()
-                                    }
-                                    
-                                    # Agregar a la cola de mensajes para procesar
-                                    message_queue.put(message_data)
-                                else:
-                                    logger.info(f"Mensaje de tipo {message_type} no soportado")
-                        
-                        # CASO 2: Procesar mensajes salientes (para detectar respuestas manuales desde nuestro número)
-                        elif 'statuses' in value:
-                            for status in value.get('statuses', []):
-                                # Solo nos interesan los mensajes salientes enviados
-                                if status.get('status') == 'sent':
-                                    recipient_id = status.get('recipient_id')
-                                    message_id = status.get('id')
-                                    
-                                    logger.info(f"Mensaje saliente detectado hacia {recipient_id} con ID {message_id}")
-                                    print("\n" + "="*50)
-                                    print(f"📤 MENSAJE SALIENTE detectado hacia {recipient_id}")
-                                    print("="*50)
-                                    
-                                    # Verificar si este número está esperando respuesta humana
-                                    if recipient_id in pending_human_queries:
-                                        # Necesitamos obtener el contenido del mensaje, pero el webhook no lo proporciona
-                                        # La solución es que verificaremos este ID de mensaje cuando llegue una confirmación de entrega
-                                        
-                                        # Almacenar el ID del mensaje para verificarlo después
-                                        outgoing_message_ids[message_id] = {
-                                            'recipient': recipient_id,
-                                            'timestamp': datetime.now().isoformat()
-                                        }
-        
-        # Devolver 200 OK para confirmar recepción
-        return web.Response(status=200, text="OK")
-    
+        # Decodificar el cuerpo una sola vez (orjson opera directo sobre bytes)
+        body = orjson.loads(await request.read())
     except Exception as e:
-        logger.error(f"Error al procesar webhook: {str(e)}")
+        logger.error("Error al procesar webhook: %s", e)
         return web.Response(status=500, text=f"Error: {str(e)}")
 
+    # Confirmar recepción de inmediato: Meta reintenta los webhooks que no
+    # reciben 200 a tiempo, así que el trabajo real se hace en segundo plano
+    _spawn(_handle_entries(body))
+    return web.Response(status=200, body=_OK_BODY)
+
+async def _handle_incoming(message):
+    """Registra y encola un mensaje entrante para los workers."""
+    # Registrar mensaje recibido (formateo diferido al logger)
+    logger.info("Mensaje recibido de %s: %s", message.sender, message.text)
+
+    # Encolar para que lo tome uno de los workers
+    await message_queue.put(message)
+
+async def _handle_entries(body):
+    """Procesa en segundo plano las entradas de un webhook ya decodificado."""
+    try:
+        # Extraer mensajes y estados en una sola pasada
+        inbound, sent_statuses = decode_webhook(body)
+
+        # CASO 1: Procesar el lote de mensajes entrantes en conjunto; un fallo
+        # en un mensaje no debe abortar el resto del lote
+        if inbound:
+            results = await asyncio.gather(
+                *(_handle_incoming(message) for message in inbound),
+                return_exceptions=True
+            )
+            for message, outcome in zip(inbound, results):
+                if isinstance(outcome, Exception):
+                    logger.error("Error al encolar mensaje %s: %s", message.msg_id, outcome)
+
+        # CASO 2: Procesar mensajes salientes (para detectar respuestas manuales desde nuestro número)
+        now = datetime.now() if sent_statuses else None
+        for recipient_id, message_id in sent_statuses:
+            logger.info("Mensaje saliente detectado hacia %s con ID %s", recipient_id, message_id)
+
+            # Verificar si este número está esperando respuesta humana
+            if await store.is_pending(recipient_id):
+                # Necesitamos obtener el contenido del mensaje, pero el webhook no lo proporciona
+                # La solución es que verificaremos este ID de mensaje cuando llegue una confirmación de entrega
+
+                # Almacenar el ID del mensaje para verificarlo después
+                _remember_outgoing(message_id, recipient_id, now)
+    
+    except Exception as e:
+        logger.error("Error al procesar webhook: %s", e)
+
 # Agregar endpoint para recibir webhooks desde Notion
 async def process_notion_webhook(request):
     """
@@ -204,12 +600,23 @@ async def process_notion_webhook(request):
         # Verificar el header de seguridad
         notion_secret = request.headers.get('X-Notion-Secret')
         if notion_secret != 'soporte123':
-            logger.warning(f"Intento de acceso no autorizado al webhook de Notion: header incorrecto")
+            logger.warning("Intento de acceso no autorizado al webhook de Notion: header incorrecto")
             return web.Response(status=403, text="Acceso no autorizado")
         
         # Obtener el cuerpo de la solicitud
-        body = await request.json()
-        logger.info(f"Webhook recibido desde Notion: {json.dumps(body)}")
+        body = await request.json(loads=orjson.loads)
+        # Serializar el payload completo solo si alguien lo va a usar: el
+        # volcado de depuración y los rescates por regex comparten la copia
+        _body_json = None
+
+        def _body_str():
+            nonlocal _body_json
+            if _body_json is None:
+                _body_json = orjson.dumps(body).decode()
+            return _body_json
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Webhook recibido desde Notion: %s", _body_str())
         
         # Extraer los datos necesarios del payload
         try:
@@ -219,94 +626,51 @@ async def process_notion_webhook(request):
                 # Si no se encuentra en data.properties, intentar acceder directamente a properties
                 properties = body.get('properties', {})
             
-            # Mostrar información de todos los datos recibidos para depuración
-            print("\n" + "="*70)
-            print("📑 DATOS RECIBIDOS DE NOTION:")
-            print(f"• Estructura de datos: {body.keys()}")
-            
-            if 'data' in body:
-                print(f"• Estructura de data: {body['data'].keys()}")
-                if 'properties' in body['data']:
-                    print(f"• Campos en data.properties: {body['data']['properties'].keys()}")
+            # Información de depuración sobre la estructura recibida
+            logger.debug("--- webhook de Notion: estructura %s, campos %s ---",
+                         list(body.keys()), list(properties.keys()))
             
-            print(f"• Campos en properties: {properties.keys()}")
-            print("-"*70)
-            
-            # Buscar el número de teléfono
+            # Buscar el número de teléfono: un índice por clave en minúsculas
+            # cubre todas las variantes de capitalización con una sonda por nombre
+            props_ci = {key.casefold(): value for key, value in properties.items()}
             telefono = ""
+            for key in _PHONE_KEYS:
+                telefono = _extract_rich_text(props_ci.get(key))
+                if telefono:
+                    logger.debug("Teléfono extraído desde '%s': %s", key, telefono)
+                    break
             
-            # Primero intentar con el nuevo campo Celular
-            celular_field = properties.get('Celular', {})
-            if celular_field and 'rich_text' in celular_field and celular_field['rich_text']:
-                telefono = celular_field['rich_text'][0].get('text', {}).get('content', '')
-                print(f"• Valor de celular extraído: {telefono}")
-            
-            # Si no se encuentra, intentar con el campo Teléfono antiguo
+            # Solo si todas las claves conocidas fallan, caer al escaneo por
+            # regex del cuerpo serializado
             if not telefono:
-                # Lista de posibles variantes del campo Teléfono
-                telefono_variants = ["Teléfono", "Telefono", "teléfono", "telefono", "Tel\u00e9fono"]
-                for variant in telefono_variants:
-                    if variant in properties:
-                        telefono_field = properties[variant]
-                        if 'rich_text' in telefono_field and telefono_field['rich_text']:
-                            telefono = telefono_field['rich_text'][0].get('text', {}).get('content', '')
-                            print(f"• Valor de teléfono extraído desde '{variant}': {telefono}")
-                            break
-            
-            # Si aún no se encuentra, buscar por formato de número
-            if not telefono:
-                print("• Buscando número por patrón numérico...")
-                for field_name, field_value in properties.items():
-                    if isinstance(field_value, dict) and 'rich_text' in field_value and field_value['rich_text']:
-                        content = field_value['rich_text'][0].get('text', {}).get('content', '')
-                        if content and len(content) > 8 and all(c.isdigit() or c == '+' for c in content):
-                            telefono = content
-                            print(f"• Encontrado número en campo '{field_name}': {telefono}")
-                            break
-            
-            # Intentar extraer dato del teléfono del cuerpo completo si aún no se encuentra
-            if not telefono:
-                print("• Buscando teléfono en el cuerpo JSON completo...")
-                json_str = json.dumps(body)
-                import re
-                phone_patterns = [
-                    r'"content"\s*:\s*"(5\d{10})"',  # Número chileno
-                    r'"content"\s*:\s*"(\+?\d{8,15})"'  # Cualquier número de teléfono
-                ]
-                for pattern in phone_patterns:
-                    matches = re.findall(pattern, json_str)
-                    if matches:
-                        telefono = matches[0]
-                        print(f"• Encontrado número mediante expresión regular: {telefono}")
+                logger.debug("Buscando teléfono en el cuerpo JSON completo...")
+                json_str = _body_str()
+                for pattern in _PHONE_PATTERNS:
+                    match = pattern.search(json_str)
+                    if match:
+                        telefono = match.group(1)
+                        logger.debug("Encontrado número mediante expresión regular: %s", telefono)
                         break
             
             # Obtener respuesta
-            respuesta = ""
-            respuesta_field = properties.get('Respuesta', {})
-            if respuesta_field and 'rich_text' in respuesta_field and respuesta_field['rich_text']:
-                respuesta = respuesta_field['rich_text'][0].get('text', {}).get('content', '')
-                print(f"• Respuesta extraída: \"{respuesta}\"")
+            respuesta = _extract_rich_text(properties.get('Respuesta'))
+            if respuesta:
+                logger.debug("Respuesta extraída: %s", respuesta)
             
             # Si no se encuentra la respuesta, buscarla en el cuerpo completo
             if not respuesta:
-                print("• Buscando respuesta en el cuerpo JSON completo...")
-                json_str = json.dumps(body)
-                import re
-                resp_match = re.search(r'"content"\s*:\s*"([^"]{2,100})"', json_str)
+                logger.debug("Buscando respuesta en el cuerpo JSON completo...")
+                resp_match = _RESP_PATTERN.search(_body_str())
                 if resp_match:
                     respuesta = resp_match.group(1)
                     # Evitar IDs o números de teléfono
                     if not respuesta.startswith(("id", "ID")) and not all(c.isdigit() or c == '-' for c in respuesta):
-                        print(f"• Posible respuesta encontrada: \"{respuesta}\"")
+                        logger.debug("Posible respuesta encontrada: %s", respuesta)
             
             # Obtener pregunta
-            pregunta = ""
-            pregunta_field = properties.get('Pregunta', {})
-            if pregunta_field and 'title' in pregunta_field and pregunta_field['title']:
-                pregunta = pregunta_field['title'][0].get('text', {}).get('content', '')
-                print(f"• Pregunta extraída: \"{pregunta}\"")
-            
-            print("="*70 + "\n")
+            pregunta = _extract_title(properties.get('Pregunta'))
+            if pregunta:
+                logger.debug("Pregunta extraída: %s", pregunta)
             
             # Verificar si tenemos los datos mínimos necesarios
             if not telefono:
@@ -314,15 +678,16 @@ async def process_notion_webhook(request):
                 # Último recurso: sacar de los pending_queries
                 if 'data' in body and 'id' in body['data']:
                     page_id = body['data']['id']
-                    print(f"• Buscando página por ID: {page_id} en consultas pendientes...")
+                    logger.debug("Buscando página por ID %s en consultas pendientes...", page_id)
                     
                     # Buscar si hay algún número pendiente
-                    if pending_human_queries:
-                        print(f"• Números pendientes: {list(pending_human_queries.keys())}")
+                    pendientes = await store.pending_numbers()
+                    if pendientes:
+                        logger.debug("Números pendientes: %s", pendientes)
                         # Si solo hay uno pendiente, usarlo
-                        if len(pending_human_queries) == 1:
-                            telefono = list(pending_human_queries.keys())[0]
-                            print(f"• Usando único número pendiente: {telefono}")
+                        if len(pendientes) == 1:
+                            telefono = pendientes[0]
+                            logger.debug("Usando único número pendiente: %s", telefono)
                     
                 # Si todavía no hay teléfono, error
                 if not telefono:
@@ -332,24 +697,19 @@ async def process_notion_webhook(request):
                 logger.error("No se encontró respuesta en el webhook de Notion")
                 return web.Response(status=400, text="No se encontró la respuesta en el webhook")
             
-            # Procesar la respuesta
-            logger.info(f"Procesando respuesta de Notion para {telefono}: {respuesta}")
-            await process_notion_response(telefono, pregunta, respuesta)
+            # Responder a Notion de inmediato y procesar en segundo plano:
+            # el envío por WhatsApp no tiene por qué retener el webhook
+            logger.info("Procesando respuesta de Notion para %s: %s", telefono, respuesta)
+            _spawn(process_notion_response(telefono, pregunta, respuesta))
             
             return web.Response(status=200, text="OK")
         
         except Exception as e:
-            logger.error(f"Error al procesar datos del webhook de Notion: {str(e)}")
-            # Imprimir el traceback completo
-            import traceback
-            print(f"❌ ERROR EN WEBHOOK DE NOTION: {str(e)}")
-            print(traceback.format_exc())
+            logger.error("Error al procesar datos del webhook de Notion: %s", e, exc_info=True)
             return web.Response(status=400, text=f"Error: {str(e)}")
     
     except Exception as e:
-        logger.error(f"Error al procesar webhook de Notion: {str(e)}")
-        import traceback
-        print(traceback.format_exc())
+        logger.error("Error al procesar webhook de Notion: %s", e, exc_info=True)
         return web.Response(status=500, text=f"Error interno: {str(e)}")
 
 async def process_notion_response(telefono, pregunta, respuesta):
@@ -363,69 +723,60 @@ async def process_notion_response(telefono, pregunta, respuesta):
     """
     try:
         # Verificar si el número está en los pendientes
-        if telefono in pending_human_queries:
-            logger.info(f"Procesando respuesta de Notion para usuario {telefono}")
-            print("\n" + "="*70)
-            print(f"📥 RECIBIDA RESPUESTA DE NOTION PARA {telefono}")
-            print("="*70)
-            print(f"• Pregunta original: \"{pregunta}\"")
-            print(f"• Respuesta: \"{respuesta}\"")
-            print("-"*70)
+        if await store.is_pending(telefono):
+            logger.info("Procesando respuesta de Notion para usuario %s", telefono)
+            # Un solo write a stdout por bloque: evita que los banners de
+            # handlers concurrentes se entremezclen línea a línea
+            print("\n".join((
+                "\n" + _SEP,
+                f"📥 RECIBIDA RESPUESTA DE NOTION PARA {telefono}",
+                _SEP,
+                f"• Pregunta original: \"{pregunta}\"",
+                f"• Respuesta: \"{respuesta}\"",
+                _SUBSEP
+            )))
             
-            # Si la pregunta está vacía, intentar recuperarla de pending_human_queries
-            if not pregunta and telefono in pending_human_queries:
-                pregunta = pending_human_queries[telefono].get('question', '')
+            # Si la pregunta está vacía, intentar recuperarla de los pendientes
+            if not pregunta:
+                pregunta = await store.pending_question(telefono)
                 print(f"ℹ️ Recuperada pregunta original de historial: \"{pregunta}\"")
             
-            # Almacenar la respuesta en la base de datos vectorial
-            try:
-                print(f"📊 Almacenando respuesta de Notion en base de datos vectorial...")
-                success, message = store_support_answer(
-                    pregunta,
-                    respuesta,
-                    source="Soporte Humano - Notion"
-                )
-                if success:
-                    print(f"✅ {message}")
-                else:
-                    print(f"⚠️ {message}")
-            except Exception as e:
-                logger.error(f"Error al almacenar respuesta: {str(e)}")
-                print(f"❌ Error al almacenar respuesta: {str(e)}")
-            
             try:
-                # Enviar la respuesta al usuario
+                # Enviar la respuesta al usuario primero: la escritura en la
+                # base vectorial puede esperar, el usuario no
                 print(f"📤 Enviando respuesta al usuario {telefono}...")
                 success = await send_whatsapp_response(telefono, respuesta)
                 
                 if success:
-                    # Actualizar historial de conversación
-                    conversation_histories.setdefault(telefono, []).append((pregunta, respuesta))
+                    # Encolar la respuesta para almacenarla en la base vectorial por lotes
+                    print(f"📊 Encolando respuesta de Notion para la base de datos vectorial...")
+                    _answer_flush_queue.put_nowait((pregunta, respuesta, "Soporte Humano - Notion"))
+                    
+                    # Actualizar historial de conversación (el prefijo se re-renderiza en el próximo mensaje)
+                    await store.append_history(telefono, pregunta, respuesta)
                     
                     # Eliminar de la lista de pendientes
-                    del pending_human_queries[telefono]
-                    if telefono in original_questions:
-                        del original_questions[telefono]
+                    await store.clear_pending(telefono)
                     
                     print(f"✅ Respuesta de Notion enviada al usuario {telefono} correctamente")
                 else:
-                    logger.error(f"Error al enviar respuesta de Notion a {telefono}")
+                    logger.error("Error al enviar respuesta de Notion a %s", telefono)
                     print(f"❌ Error al enviar respuesta de Notion a {telefono}")
             
             except Exception as e:
-                logger.error(f"Error al enviar respuesta de Notion: {str(e)}")
+                logger.error("Error al enviar respuesta de Notion: %s", e, exc_info=True)
                 print(f"❌ Error al enviar respuesta de Notion: {str(e)}")
                 
-            print("="*70 + "\n")
+            print(_SEP + "\n")
         else:
-            logger.warning(f"Recibida respuesta para número no pendiente: {telefono}")
+            logger.warning("Recibida respuesta para número no pendiente: %s", telefono)
             print(f"⚠️ Recibida respuesta para usuario no pendiente: {telefono}")
     
     except Exception as e:
-        logger.error(f"Error al procesar respuesta de Notion: {str(e)}")
+        logger.error("Error al procesar respuesta de Notion: %s", e, exc_info=True)
         print(f"❌ Error al procesar respuesta de Notion: {str(e)}")
 
-def create_notion_ticket(phone_number, question):
+async def create_notion_ticket(phone_number, question):
     """
     Crea un ticket en la base de datos de Notion.
     
@@ -447,16 +798,8 @@ def create_notion_ticket(phone_number, question):
         return None
     
     try:
-        # Generar ID único para el ticket
-        ticket_id = str(uuid.uuid4())
-        
-        # Configurar cabeceras y URL
-        headers = {
-            "Authorization": f"Bearer {NOTION_API_KEY}",
-            "Content-Type": "application/json",
-            "Notion-Version": "2022-06-28"
-        }
-        url = f"https://api.notion.com/v1/pages"
+        # Generar ID único para el ticket (hex: más corto y sin guiones)
+        ticket_id = uuid.uuid4().hex
         
         # Preparar datos para la creación del ticket
         data = {
@@ -495,197 +838,237 @@ def create_notion_ticket(phone_number, question):
             }
         }
         
-        # Realizar solicitud a la API de Notion
-        response = requests.post(url, headers=headers, json=data)
-        
-        # Verificar respuesta
-        if response.status_code == 200:
-            page_id = response.json().get("id")
-            logger.info(f"Ticket creado en Notion con ID: {page_id}")
-            print(f"✅ Ticket creado en Notion para {phone_number}")
-            return page_id
-        else:
-            logger.error(f"Error al crear ticket en Notion: {response.status_code} - {response.text}")
-            print(f"❌ Error al crear ticket en Notion: respuesta {response.status_code}")
-            print(f"   Detalle: {response.text[:200]}...")
-            return None
+        # Realizar solicitud a la API de Notion con la sesión compartida;
+        # el payload va pre-serializado con orjson (bytes directos, las
+        # cabeceras ya declaran application/json)
+        async with notion_session.post(NOTION_PAGES_URL, headers=NOTION_HEADERS, data=orjson.dumps(data)) as response:
+            # Verificar respuesta
+            if response.status == 200:
+                response_data = await response.json(loads=orjson.loads)
+                page_id = response_data.get("id")
+                logger.info("Ticket creado en Notion con ID: %s", page_id)
+                print(f"✅ Ticket creado en Notion para {phone_number}")
+                return page_id
+            else:
+                response_text = await response.text()
+                logger.error("Error al crear ticket en Notion: %s - %s", response.status, response_text)
+                print(f"❌ Error al crear ticket en Notion: respuesta {response.status}")
+                print(f"   Detalle: {response_text[:200]}...")
+                return None
     
     except Exception as e:
-        logger.error(f"Excepción al crear ticket en Notion: {str(e)}")
+        logger.error("Excepción al crear ticket en Notion: %s", e, exc_info=True)
         print(f"❌ Excepción al crear ticket en Notion: {str(e)}")
         return None
 
-def process_message_with_agents(message_data):
+# Máximo de mensajes que un worker drena de la cola en una pasada
+WORKER_BATCH = 32
+
+async def _message_worker():
+    """Worker que consume mensajes de la cola y los procesa con los agentes."""
+    while True:
+        # Esperar el primero y drenar lo que haya acumulado la ráfaga: los
+        # mensajes de números distintos son independientes y pueden correr
+        # juntos (el semáforo ya acota las ejecuciones de agentes)
+        batch = [await message_queue.get()]
+        while len(batch) < WORKER_BATCH:
+            try:
+                batch.append(message_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        try:
+            results = await asyncio.gather(
+                *(process_message_with_agents(message) for message in batch),
+                return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error("Error en el worker de mensajes: %s", result)
+        finally:
+            for _ in batch:
+                message_queue.task_done()
+
+async def process_message_with_agents(message_data):
     """
     Procesa un mensaje a través del sistema de agentes.
-    
+
     Args:
         message_data: Diccionario con datos del mensaje
     """
+    # Acotar cuántas ejecuciones de agentes corren en paralelo
+    async with _agent_semaphore:
+        await _process_message_with_agents(message_data)
+
+async def _process_message_with_agents(message_data):
     try:
-        from_number = message_data['from']
-        message_text = message_data['text']
-        phone_number_id = os.environ.get("WHATSAPP_PHONE_NUMBER_ID")
+        from_number = message_data.sender
+        message_text = message_data.text
         
         # CASO 1: Es un mensaje desde nuestro propio número (soporte manual)
         # Buscar si hay una consulta pendiente para el número al que se envió y guardar en vectores
         # Esto se maneja ahora en el webhook de statuses
         
         # CASO 2: Es un usuario esperando respuesta de soporte humano
-        if from_number in pending_human_queries:
-            logger.info(f"Usuario {from_number} está esperando respuesta humana")
+        if await store.is_pending(from_number):
+            logger.info("Usuario %s está esperando respuesta humana", from_number)
             
-            # Informar al usuario que su consulta sigue en proceso
-            new_loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(new_loop)
-            try:
-                new_loop.run_until_complete(
-                    send_whatsapp_response(
-                        from_number, 
-                        "Tu consulta ha sido transferida a un especialista humano. " +
-                        "En breve recibirás una respuesta. Gracias por tu paciencia."
-                    )
-                )
-            finally:
-                new_loop.close()
+            # Si el usuario insiste, no repetir el aviso más de una vez por minuto
+            if not await store.ack_allowed(from_number):
+                return
+            
+            # Informar al usuario que su consulta sigue en proceso; el aviso
+            # es cortesía, no hace falta retener el worker esperando el envío
+            _spawn(send_whatsapp_response(from_number, HUMAN_WAIT_REPLY))
             return
         
         # CASO 3: Es un mensaje normal que debe procesarse con los agentes
         else:
-            # Obtener historial de conversación
-            conversation_history = conversation_histories.get(from_number, [])
-            
-            logger.info(f"Procesando mensaje de {from_number} a través del sistema de agentes")
-            
-            # Crear un nuevo evento loop para procesar el mensaje
-            new_loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(new_loop)
+            Runner, simple_response_agent, simple_agent_name, human_agent_name = _get_agents()
+
+            # Obtener los últimos turnos del historial de conversación
+            conversation_history = await store.recent_history(from_number)
             
-            try:
-                # Reiniciar el tracker para esta ejecución
-                tracker.reset()
-                
-                # Preparar contexto si hay historial de conversación
-                if conversation_history:
-                    context = "\n\nHistorial de conversación anterior:\n"
-                    for i, (user_msg, assistant_msg) in enumerate(conversation_history[-3:]):
-                        context += f"Usuario: {user_msg}\nAsistente: {assistant_msg}\n"
-                    context += f"\nConsulta actual: {message_text}"
-                    tracker.contexts.append("Conversación previa incluida")
-                    result = new_loop.run_until_complete(Runner.run(simple_response_agent, input=context))
+            logger.info("Procesando mensaje de %s a través del sistema de agentes", from_number)
+
+            # Tracker local a esta ejecución: permite correr mensajes en
+            # paralelo sin que se pisen el estado entre sí
+            tracker = RunTracker()
+
+            # Preparar contexto si hay historial de conversación
+            if conversation_history:
+                if store.is_shared:
+                    # Con Redis otros procesos agregan turnos que este proceso
+                    # no ve: el caché local mentiría, se renderiza siempre
+                    prefix = _render_history_prompt(conversation_history)
                 else:
-                    result = new_loop.run_until_complete(Runner.run(simple_response_agent, input=message_text))
-                
-                # Registrar el último agente utilizado
-                last_agent_name = getattr(result.last_agent, 'name', 'Unknown')
-                print(f"🤖 Agente actual: '{last_agent_name}'")
-                
-                # Registrar el agente inicial
-                tracker.agent_names.append(simple_response_agent.name)
-                
-                # Extraer detalles de la ejecución
-                for item in result.new_items:        
-                    # Registrar handoffs
-                    if hasattr(item, 'to_agent') and hasattr(item, 'from_agent'):
-                        handoff_from = getattr(item.from_agent, 'name', 'Unknown')
-                        handoff_to = getattr(item.to_agent, 'name', 'Unknown')
-                        tracker.handoffs.append(f"{handoff_from} → {handoff_to}")
-                        tracker.agent_names.append(handoff_to)
-                    
-                    # Registrar resultados de búsqueda
-                    if hasattr(item, 'type') and item.type == 'file_search_call':
-                        try:
-                            if hasattr(item, 'results') and item.results:
-                                for result_item in item.results:
-                                    if hasattr(result_item, 'text') and result_item.text:
-                                        # Obtener un extracto
-                                        text_snippet = result_item.text[:100] + "..." if len(result_item.text) > 100 else result_item.text
-                                        filename = getattr(result_item, 'filename', 'unknown')
-                                        score = getattr(result_item, 'score', 0)
-                                        tracker.vector_results.append(f"Archivo: {filename}, Relevancia: {score:.2f}, Extracto: {text_snippet}")
-                        except Exception as e:
-                            tracker.vector_results.append(f"Error al procesar resultados: {str(e)}")
-                
-                # Verificar si se ha derivado a soporte humano
-                if hasattr(result.last_agent, 'name') and result.last_agent.name == human_support_agent.name:
-                    # Guardar la pregunta original
-                    original_questions[from_number] = message_text
-                    
-                    # Marcar que está esperando respuesta humana
-                    pending_human_queries[from_number] = {
-                        'question': message_text,
-                        'timestamp': datetime.now().isoformat()
-                    }
-                    
-                    # Mostrar en terminal alerta para soporte humano
-                    print("\n" + "="*70)
-                    print("🔔 ALERTA: SE REQUIERE RESPUESTA HUMANA - DERIVANDO A NOTION")
-                    print("="*70)
-                    print(f"• Usuario: {from_number}")
-                    print(f"• Consulta: \"{message_text}\"")
-                    print(f"• Fecha/Hora: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-                    print("-"*70)
-                    
-                    # Crear ticket en Notion
-                    notion_page_id = create_notion_ticket(from_number, message_text)
-                    
-                    if notion_page_id:
-                        print("✅ Se ha creado un ticket en Notion para responder a esta consulta")
-                        print("   Un agente humano responderá a través de Notion")
-                        
+                    # El prefijo del historial solo cambia cuando se agrega un
+                    # turno, así que se reutiliza la versión cacheada si existe
+                    prefix = conversation_prompt_cache.get(from_number)
+                    if prefix is None:
+                        prefix = _render_history_prompt(conversation_history)
+                        conversation_prompt_cache[from_number] = prefix
+                        if len(conversation_prompt_cache) > _PROMPT_CACHE_MAX:
+                            conversation_prompt_cache.popitem(last=False)
                     else:
-                        print("⚠️ No se pudo crear el ticket en Notion")
-                        print("   La consulta queda pendiente de respuesta manual")
-                        
-                        # Informamos al usuario con un mensaje diferente en caso de error
-                        new_loop.run_until_complete(
-                            send_whatsapp_response(
-                                from_number, 
-                                "Tu consulta requiere asistencia especializada. Un humano revisará tu caso y te responderá lo antes posible. Gracias por tu paciencia."
-                            )
-                        )
-                    
-                    print("="*70 + "\n")
+                        conversation_prompt_cache.move_to_end(from_number)
+                context = prefix + f"\nConsulta actual: {message_text}"
+                tracker.contexts.append("Conversación previa incluida")
+                result = await Runner.run(simple_response_agent, input=context)
+            else:
+                result = await Runner.run(simple_response_agent, input=message_text)
+
+            # Registrar el último agente utilizado
+            last_agent_name = getattr(result.last_agent, 'name', 'Unknown')
+            logger.debug("Agente actual: '%s'", last_agent_name)
+
+            # Registrar el agente inicial
+            tracker.agent_names.append(simple_agent_name)
+
+            # Extraer detalles de la ejecución: un único try alrededor del
+            # recorrido completo y guardas con continue en lugar de un
+            # try/except dentro del bucle caliente. Los métodos append se
+            # pre-ligan a locales para evitar las búsquedas de atributo
+            # repetidas en cadenas largas de items
+            append_handoff = tracker.handoffs.append
+            append_agent = tracker.agent_names.append
+            append_vector = tracker.vector_results.append
+            try:
+                for item in result.new_items:
+                    # Registrar handoffs (una sola sonda de atributos por item,
+                    # en lugar de pares hasattr/getattr)
+                    from_agent = getattr(item, 'from_agent', None)
+                    to_agent = getattr(item, 'to_agent', None)
+                    if from_agent is not None and to_agent is not None:
+                        handoff_from = getattr(from_agent, 'name', 'Unknown')
+                        handoff_to = getattr(to_agent, 'name', 'Unknown')
+                        append_handoff(f"{handoff_from} → {handoff_to}")
+                        append_agent(handoff_to)
+
+                    # Registrar resultados de búsqueda
+                    if getattr(item, 'type', None) != 'file_search_call':
+                        continue
+                    results = getattr(item, 'results', None)
+                    if not results:
+                        continue
+                    for result_item in results:
+                        text = getattr(result_item, 'text', None)
+                        if not text:
+                            continue
+                        # Guardar la tupla cruda; el extracto se arma en format_logs
+                        append_vector((
+                            getattr(result_item, 'filename', 'unknown'),
+                            getattr(result_item, 'score', 0),
+                            text
+                        ))
+            except Exception as e:
+                append_vector(f"Error al procesar resultados: {str(e)}")
+
+            # Verificar si se ha derivado a soporte humano
+            if getattr(result.last_agent, 'name', None) == human_agent_name:
+                # Marcar que está esperando respuesta humana
+                await store.mark_pending(from_number, message_text, message_data.ts)
+
+                # Mostrar en terminal alerta para soporte humano (un solo
+                # write para que no se entremezcle con otros workers)
+                print("\n".join((
+                    "\n" + _SEP,
+                    "🔔 ALERTA: SE REQUIERE RESPUESTA HUMANA - DERIVANDO A NOTION",
+                    _SEP,
+                    f"• Usuario: {from_number}",
+                    f"• Consulta: \"{message_text}\"",
+                    f"• Fecha/Hora: {str(message_data.ts)[:19]}",
+                    _SUBSEP
+                )))
+
+                # Crear ticket en Notion
+                notion_page_id = await create_notion_ticket(from_number, message_text)
+
+                if notion_page_id:
+                    print("✅ Se ha creado un ticket en Notion para responder a esta consulta\n"
+                          "   Un agente humano responderá a través de Notion")
+
                 else:
-                    # Respuesta normal del sistema de agentes
-                    response = result.final_output
-                    
-                    # Enviar respuesta al usuario
-                    new_loop.run_until_complete(send_whatsapp_response(from_number, response))
-                    
-                    # Mostrar logs internos en la consola (versión reducida)
+                    print("⚠️ No se pudo crear el ticket en Notion\n"
+                          "   La consulta queda pendiente de respuesta manual")
+
+                    # Informamos al usuario con un mensaje diferente en caso de error
+                    await send_whatsapp_response(
+                        from_number,
+                        "Tu consulta requiere asistencia especializada. Un humano revisará tu caso y te responderá lo antes posible. Gracias por tu paciencia."
+                    )
+
+                print(_SEP + "\n")
+            else:
+                # Respuesta normal del sistema de agentes
+                response = result.final_output
+
+                # El envío al usuario y la actualización del historial son
+                # independientes: correrlos juntos deja la latencia en el
+                # máximo de ambos en vez de la suma
+                await asyncio.gather(
+                    send_whatsapp_response(from_number, response),
+                    store.append_history(from_number, message_text, response)
+                )
+
+                # Registrar logs internos solo si alguien los va a leer
+                if logger.isEnabledFor(logging.DEBUG):
                     internal_logs = tracker.format_logs()
                     if internal_logs:
-                        print("\n📋 Detalles de ejecución:")
-                        print(internal_logs)
-                    
-                    # Actualizar historial de conversación
-                    conversation_histories.setdefault(from_number, []).append((message_text, response))
-            
-            finally:
-                # Cerrar el evento loop
-                new_loop.close()
+                        logger.debug("Detalles de ejecución:\n%s", internal_logs)
     
     except Exception as e:
-        logger.error(f"Error al procesar mensaje: {str(e)}")
+        logger.error("Error al procesar mensaje: %s", e, exc_info=True)
         # Enviar mensaje de error al usuario
         try:
-            error_loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(error_loop)
-            try:
-                error_loop.run_until_complete(
-                    send_whatsapp_response(
-                        message_data['from'], 
-                        "Lo siento, ha ocurrido un error al procesar tu mensaje. Por favor, intenta nuevamente más tarde."
-                    )
-                )
-            finally:
-                error_loop.close()
+            await send_whatsapp_response(
+                message_data.sender,
+                "Lo siento, ha ocurrido un error al procesar tu mensaje. Por favor, intenta nuevamente más tarde."
+            )
         except Exception as inner_e:
-            logger.error(f"Error al enviar mensaje de error: {str(inner_e)}")
+            logger.error("Error al enviar mensaje de error: %s", inner_e, exc_info=True)
 
 # Añadir función para detectar y procesar los mensajes salientes manuales
-def process_manual_response(to_number, message_text):
+async def process_manual_response(to_number, message_text):
     """
     Procesa respuestas manuales de soporte enviadas a un usuario.
     
@@ -694,42 +1077,24 @@ def process_manual_response(to_number, message_text):
         message_text: Texto del mensaje enviado
     """
     try:
-        # Verificar si el número está esperando respuesta humana
-        if to_number in pending_human_queries:
-            original_question = pending_human_queries[to_number]['question']
-            
+        # Extraer y eliminar la consulta pendiente en una sola operación
+        original_question = await store.pop_pending(to_number)
+        if original_question is not None:
             print(f"🔄 Procesando respuesta manual a {to_number}")
             
-            # Almacenar la respuesta en la base de datos vectorial
-            try:
-                print("📊 Almacenando respuesta humana en base de datos vectorial...")
-                success, _ = store_support_answer(
-                    original_question,
-                    message_text,
-                    source="Soporte Humano - Manual"
-                )
-                if success:
-                    print("✅ Respuesta almacenada correctamente")
-            except Exception as e:
-                logger.error(f"Error al almacenar respuesta: {str(e)}")
+            # Encolar la respuesta para almacenarla en la base vectorial por lotes
+            print("📊 Encolando respuesta humana para la base de datos vectorial...")
+            _answer_flush_queue.put_nowait((original_question, message_text, "Soporte Humano - Manual"))
             
             # Actualizar historial de conversación del usuario
-            if to_number in conversation_histories:
-                conversation_histories[to_number].append(
-                    (original_question, message_text)
-                )
-            
-            # Eliminar de la lista de pendientes
-            del pending_human_queries[to_number]
-            if to_number in original_questions:
-                del original_questions[to_number]
+            await store.append_history(to_number, original_question, message_text)
             
             print(f"✅ Consulta de {to_number} marcada como respondida")
             return True
         else:
             return False
     except Exception as e:
-        logger.error(f"Error al procesar respuesta manual: {str(e)}")
+        logger.error("Error al procesar respuesta manual: %s", e, exc_info=True)
         return False
 
 async def send_whatsapp_response(to_number, message_text):
@@ -744,53 +1109,35 @@ async def send_whatsapp_response(to_number, message_text):
         bool: True si el mensaje se envió correctamente, False en caso contrario
     """
     try:
-        # Obtener ID del teléfono de WhatsApp Business
-        phone_number_id = os.environ.get("WHATSAPP_PHONE_NUMBER_ID")
-        
         # Mostrar en consola lo que se va a enviar
         print(f"\n📤 Enviando a {to_number}:\n\"{message_text}\"")
         
-        # Enviar mensaje
-        result = await send_whatsapp_message(to_number, message_text, phone_number_id)
+        # Enviar mensaje (el ID del teléfono ya está cacheado a nivel de módulo)
+        result = await send_whatsapp_message(to_number, message_text, our_phone_number_id)
         
         # Verificar resultado
         if "success" in result and result["success"]:
-            logger.info(f"Respuesta enviada a {to_number}")
+            logger.info("Respuesta enviada a %s", to_number)
             return True
         else:
-            logger.error(f"Error al enviar respuesta: {json.dumps(result)}")
+            # %r difiere la representación del payload al propio logger:
+            # si el registro se filtra, no se serializa nada
+            logger.error("Error al enviar respuesta: %r", result)
             return False
     
     except Exception as e:
-        logger.error(f"Excepción al enviar respuesta: {str(e)}")
+        logger.error("Excepción al enviar respuesta: %s", e, exc_info=True)
         return False
 
-def message_processor_thread():
-    """
-    Hilo para procesar mensajes de forma continua.
-    """
-    logger.info("Iniciando procesador de mensajes")
-    
-    while True:
-        try:
-            # Obtener mensaje de la cola (bloqueante)
-            message = message_queue.get()
-            
-            # Procesar mensaje con agentes
-            process_message_with_agents(message)
-            
-            # Marcar como completado
-            message_queue.task_done()
-        
-        except Exception as e:
-            logger.error(f"Error en el procesador de mensajes: {str(e)}")
-            # Continuar procesando mensajes aunque haya un error
-
 async def start_webhook_server(host='0.0.0.0', port=8080):
     """
     Inicia el servidor de webhook de WhatsApp.
     """
-    app = web.Application()
+    app = web.Application(client_max_size=MAX_WEBHOOK_BODY)
+    
+    # Sesiones HTTP compartidas ligadas al ciclo de vida de la app
+    app.on_startup.append(_init_http_sessions)
+    app.on_cleanup.append(_close_http_sessions)
     
     # Rutas del webhook
     app.router.add_get('/webhook', verify_webhook)
@@ -805,7 +1152,7 @@ async def start_webhook_server(host='0.0.0.0', port=8080):
     site = web.TCPSite(runner, host, port)
     await site.start()
     
-    logger.info(f"Servidor webhook iniciado en http://{host}:{port}")
+    logger.info("Servidor webhook iniciado en http://%s:%s", host, port)
     print(f"Endpoint de Notion disponible en: http://{host}:{port}/notion-webhook")
     
     return runner
@@ -814,29 +1161,33 @@ async def main():
     """
     Función principal.
     """
-    # Imprimir información
-    print("\n" + "="*70)
-    print("🤖 SISTEMA DE AGENTES C1DO1 CON INTEGRACIÓN WHATSAPP Y NOTION")
-    print("="*70)
-    print("Este sistema procesa mensajes de WhatsApp a través del sistema de agentes C1DO1")
-    print("y crea tickets en Notion para respuestas humanas cuando es necesario.")
-    
-    # Inicializar diccionario para mensajes salientes
-    global outgoing_message_ids
-    outgoing_message_ids = {}
-    
-    print("\n📋 IMPORTANTE:")
-    print("  • Las consultas que requieran respuesta humana se registrarán en Notion")
-    print("  • Responda desde Notion usando el botón 'Enviar Respuesta'")
-    print("  • Las respuestas se almacenarán en la base de datos vectorial automáticamente")
-    print("  • Este servidor debe ser accesible desde internet")
-    print("  • Asegúrate de que ngrok esté corriendo")
+    # Las corrutinas cortas (envíos cacheados, fallos rápidos) se ejecutan
+    # hasta su primer await real sin pasar por el planificador del loop.
+    # Disponible desde Python 3.12; en versiones anteriores no hay cambio.
+    if hasattr(asyncio, "eager_task_factory"):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+
+    # Imprimir información (un solo write por bloque)
+    print("\n".join((
+        "\n" + _SEP,
+        "🤖 SISTEMA DE AGENTES C1DO1 CON INTEGRACIÓN WHATSAPP Y NOTION",
+        _SEP,
+        "Este sistema procesa mensajes de WhatsApp a través del sistema de agentes C1DO1",
+        "y crea tickets en Notion para respuestas humanas cuando es necesario.",
+        "",
+        "📋 IMPORTANTE:",
+        "  • Las consultas que requieran respuesta humana se registrarán en Notion",
+        "  • Responda desde Notion usando el botón 'Enviar Respuesta'",
+        "  • Las respuestas se almacenarán en la base de datos vectorial automáticamente",
+        "  • Este servidor debe ser accesible desde internet",
+        "  • Asegúrate de que ngrok esté corriendo"
+    )))
     
     # Verificar integración con Notion
     if not NOTION_API_KEY or not NOTION_DATABASE_ID:
-        print("\n⚠️ ADVERTENCIA: Integración con Notion no configurada")
-        print("  • Comprueba que las variables NOTION_API_KEY y NOTION_DATABASE_ID")
-        print("    estén correctamente establecidas en tu archivo .env")
+        print("\n⚠️ ADVERTENCIA: Integración con Notion no configurada\n"
+              "  • Comprueba que las variables NOTION_API_KEY y NOTION_DATABASE_ID\n"
+              "    estén correctamente establecidas en tu archivo .env")
     else:
         print("\n✅ Integración con Notion configurada correctamente")
     
@@ -845,17 +1196,19 @@ async def main():
         print("\n🔄 CONSULTAS PENDIENTES DE RESPUESTA:")
         for number, query_data in pending_human_queries.items():
             print(f"  • Usuario: {number}")
-            print(f"    Consulta: \"{query_data['question']}\"")
-            print(f"    Fecha: {datetime.fromisoformat(query_data['timestamp']).strftime('%Y-%m-%d %H:%M:%S')}")
+            print(f"    Consulta: \"{query_data.question}\"")
+            print(f"    Fecha: {query_data.timestamp.strftime('%Y-%m-%d %H:%M:%S')}")
             print()
     
-    print("\nPresiona Ctrl+C para detener el servidor")
-    print("="*70 + "\n")
-    
-    # Iniciar procesador de mensajes en hilo separado
-    processor_thread = threading.Thread(target=message_processor_thread, daemon=True)
-    processor_thread.start()
+    print("\nPresiona Ctrl+C para detener el servidor\n" + _SEP + "\n")
     
+    # Iniciar los workers que consumen la cola de mensajes; las referencias
+    # viven en este scope durante toda la vida del servidor
+    worker_tasks = [asyncio.create_task(_message_worker()) for _ in range(AGENT_CONCURRENCY)]
+
+    # Iniciar el almacenamiento por lotes de respuestas en la base vectorial
+    flusher_task = asyncio.create_task(_answer_flusher())
+
     # Iniciar servidor webhook
     runner = await start_webhook_server()
     
@@ -866,13 +1219,24 @@ async def main():
     except asyncio.CancelledError:
         logger.info("Tarea principal cancelada")
     except Exception as e:
-        logger.error(f"Error en la tarea principal: {str(e)}")
+        logger.error("Error en la tarea principal: %s", e, exc_info=True)
     finally:
-        # Cerrar el servidor correctamente
+        # Detener workers y flusher antes de cerrar el servidor
+        for task in worker_tasks:
+            task.cancel()
+        flusher_task.cancel()
         await runner.cleanup()
         logger.info("Servidor detenido correctamente")
 
 if __name__ == "__main__":
+    # uvloop baja el costo por callback del loop; si no está instalado se
+    # sigue con el loop estándar sin más
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt: